@@ -1,57 +1,154 @@
-import sqlite3
-from datetime import datetime, timedelta
-
-DB_PATH = "data.db"
+import time
+from cache import ttl_cache
+from db import get_conn
+
+# Query text is kept in module constants so every call hands the connection's
+# statement cache the same string and hits the already-prepared statement.
+_Q_RECENT = '''
+    SELECT latency, packet_loss, rx_bytes, tx_bytes, timestamp
+    FROM metrics
+    WHERE timestamp BETWEEN ? AND ?
+    ORDER BY timestamp DESC
+'''
+_Q_BASELINE = '''
+    SELECT AVG(latency)
+    FROM metrics
+    WHERE timestamp BETWEEN ? AND ?
+'''
+_Q_SUMMARY = '''
+    SELECT COUNT(*), AVG(latency), MAX(latency), AVG(packet_loss)
+    FROM metrics
+    WHERE timestamp BETWEEN ? AND ?
+'''
+_Q_LATENCY_COUNT = '''
+    SELECT COUNT(latency)
+    FROM metrics
+    WHERE timestamp BETWEEN ? AND ?
+'''
+_Q_LATENCY_RANK = '''
+    SELECT latency
+    FROM metrics
+    WHERE timestamp BETWEEN ? AND ? AND latency IS NOT NULL
+    ORDER BY latency
+    LIMIT 2 OFFSET ?
+'''
+_Q_LATEST = 'SELECT id, timestamp FROM metrics ORDER BY id DESC LIMIT 1'
 
 def get_recent_metrics(seconds=180):
     """Get metrics from the last N seconds."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
-        # Use consistent string format that matches collector’s datetime.now() output
-        cutoff_time = (datetime.now() - timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M:%S")
-
-        c.execute('''
-            SELECT latency, packet_loss, rx_bytes, tx_bytes, timestamp
-            FROM metrics
-            WHERE timestamp >= ?
-            ORDER BY timestamp DESC
-        ''', (cutoff_time,))
-
-        rows = c.fetchall()
-        conn.close()
-        return rows
+        with get_conn() as conn:
+            c = conn.cursor()
+
+            # Timestamps are stored as integer Unix epoch seconds
+            now = int(time.time())
+
+            c.execute(_Q_RECENT, (now - seconds, now))
+            c.arraysize = 50
+
+            rows = []
+            while batch := c.fetchmany():
+                rows.extend(batch)
+            return rows
     except Exception as e:
         print(f"Error fetching metrics: {e}")
         return []
 
+@ttl_cache(10)
 def get_baseline_latency(seconds=300):
     """Get average latency from recent history (baseline)."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+        with get_conn() as conn:
+            c = conn.cursor()
 
-        cutoff_time = (datetime.now() - timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M:%S")
+            now = int(time.time())
 
-        c.execute('''
-            SELECT AVG(latency)
-            FROM metrics
-            WHERE timestamp >= ?
-        ''', (cutoff_time,))
+            c.execute(_Q_BASELINE, (now - seconds, now))
 
-        result = c.fetchone()
-        conn.close()
+            result = c.fetchone()
 
-        if result and result[0]:
-            return result[0]
-        return 40.0  # Default baseline if not enough data
+            if result and result[0]:
+                return result[0]
+            return 40.0  # Default baseline if not enough data
     except Exception as e:
         print(f"Error getting baseline: {e}")
         return 40.0
 
+@ttl_cache(5)
+def get_summary_stats(seconds=300):
+    """Aggregate latency/loss over the last N seconds inside SQLite.
+
+    Returns a dict with samples, avg_latency, max_latency and avg_packet_loss,
+    or None if the query fails.
+    """
+    try:
+        with get_conn() as conn:
+            c = conn.cursor()
+
+            now = int(time.time())
+
+            c.execute(_Q_SUMMARY, (now - seconds, now))
+            samples, avg_latency, max_latency, avg_loss = c.fetchone()
+
+            return {
+                "samples": samples,
+                "avg_latency": avg_latency,
+                "max_latency": max_latency,
+                "avg_packet_loss": avg_loss
+            }
+    except Exception as e:
+        print(f"Error getting summary stats: {e}")
+        return None
+
+@ttl_cache(5)
+def get_p95_latency(seconds=300):
+    """Exact p95 latency over the last N seconds (linear interpolation), or None."""
+    try:
+        with get_conn() as conn:
+            c = conn.cursor()
+
+            now = int(time.time())
+
+            c.execute(_Q_LATENCY_COUNT, (now - seconds, now))
+            latency_count = c.fetchone()[0]
+            if not latency_count:
+                return None
+
+            # Only the two neighbouring ranks are fetched
+            k = (latency_count - 1) * 0.95
+            f = int(k)
+            c.execute(_Q_LATENCY_RANK, (now - seconds, now, f))
+            vals = [r[0] for r in c.fetchall()]
+            p95_latency = vals[0]
+            if len(vals) > 1:
+                p95_latency += (vals[1] - vals[0]) * (k - f)
+            return p95_latency
+    except Exception as e:
+        print(f"Error getting p95 latency: {e}")
+        return None
+
+def get_latest_sample():
+    """Return (id, timestamp) of the newest metrics row, or None."""
+    try:
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute(_Q_LATEST)
+            return c.fetchone()
+    except Exception as e:
+        print(f"Error getting latest sample: {e}")
+        return None
+
+# Newest sample the last analysis was computed from
+_LAST = {"sample": None, "result": None}
+
+@ttl_cache(2)
 def analyze_network():
     """Analyze network metrics and detect anomalies."""
+    # Nothing new since the last run: reuse it while that sample is still in the window
+    latest = get_latest_sample()
+    if latest is not None and latest == _LAST["sample"] and latest[1] >= int(time.time()) - 180:
+        return _LAST["result"]
+
     recent = get_recent_metrics(seconds=180)
 
     if not recent:
@@ -79,7 +176,7 @@ def analyze_network():
     else:
         summary = f"Network health normal. Latency: {latency:.1f}ms, No packet loss."
 
-    return {
+    result = {
         "current_latency": latency,
         "baseline_latency": baseline_latency,
         "latency_spike_percent": latency_spike,
@@ -87,6 +184,8 @@ def analyze_network():
         "summary": summary,
         "has_issues": len(issues) > 0
     }
+    _LAST["sample"], _LAST["result"] = latest, result
+    return result
 
 if __name__ == "__main__":
     analysis = analyze_network()
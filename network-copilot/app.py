@@ -5,13 +5,35 @@ GLOBAL_THRESHOLDS = {
 }
 # Example per-device override: { '192.168.50.176': {'latency': 150, 'loss': 2.0} }
 PER_DEVICE_THRESHOLDS = {}
-from flask import Flask, render_template, jsonify, Response
+from flask import Flask, render_template, jsonify, request, Response
 from metrics_collector import start_collection
-from analyzer import analyze_network, get_recent_metrics
-from llm_wrapper import get_llm_diagnosis
+from analyzer import analyze_network, get_summary_stats, get_p95_latency
+from llm_wrapper import get_llm_diagnosis, stream_llm_diagnosis
 from device_discovery import discover_devices
-import sqlite3
+from db import get_conn
+from cache import ttl_cache
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import json
+import os
 import re
+import sqlite3
+import threading
+import time
+
+# orjson is optional; fall back to Flask's jsonify when it is not installed
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# google-re2 is optional; the stdlib re module is used otherwise
+try:
+    import re2 as _re
+except ImportError:
+    _re = re
 
 app = Flask(__name__)
 
@@ -21,6 +43,12 @@ try:
 except Exception as e:
     print(f"[metrics] background collection failed to start: {e}")
 
+def _json_response(payload, status=200):
+    """Serialize a JSON response with orjson when available. Every route uses this."""
+    if HAS_ORJSON:
+        return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+    return jsonify(payload), status
+
 def _rate_latency(ms: float) -> str:
     if ms is None:
         return "unknown"
@@ -29,57 +57,73 @@ def _rate_latency(ms: float) -> str:
     if ms < 100: return "fair"
     return "poor"
 
+# Hostname heuristics (expanded), in priority order
+_HOSTNAME_RULES = (
+    (("iphone", "ios"), "phone (iPhone/iOS)"),
+    (("ipad",), "tablet (iPad/iOS)"),
+    (("android", "pixel", "galaxy", "oneplus", "samsung"), "phone (Android)"),
+    (("macbook", "imac", "mac-mini", "macpro", "macos"), "laptop/desktop (Mac)"),
+    (("intel", "nuc"), "desktop (Intel)"),
+    (("windows", "win", "dell", "hp", "lenovo", "thinkpad", "xps", "surface", "msi", "acer", "asus"), "laptop/desktop (Windows/PC)"),
+    (("laptop", "notebook"), "laptop (generic)"),
+    (("desktop", "pc"), "desktop (generic)"),
+    (("roku", "apple-tv", "firetv", "chromecast", "tv"), "streaming/TV"),
+    (("ps5", "ps4", "xbox", "switch"), "game console"),
+)
+# One compiled alternation per rule, checked in priority order. Uses google-re2
+# (linear-time matching) when installed, otherwise the stdlib engine.
+_HOSTNAME_PATTERNS = tuple(
+    (_re.compile("|".join(map(re.escape, keywords))), label) for keywords, label in _HOSTNAME_RULES
+)
+
+# OUI (MAC prefix) heuristics (expanded), flattened to one prefix -> type dict
+_OUI_MAP = {
+    oui: label
+    for label, ouis in (
+        ("Apple device (Mac/iOS)", ("88:e9:fe", "d8:30:62", "8c:85:90", "f0:18:98", "a4:5e:60", "b8:8d:12", "ac:bc:32")),
+        ("Samsung device (Android)", ("1c:5a:6b", "14:32:d1", "30:07:4d", "f4:09:d8", "00:16:6c")),
+        ("Google device (Android/IoT)", ("3c:5a:b4", "f4:f5:d8", "a4:77:33", "e4:f0:42")),
+        ("Intel device (PC/NIC)", ("00:1b:21", "00:13:e8", "00:03:47", "00:15:17")),
+        ("Dell device (PC)", ("00:14:22", "00:1a:a0", "00:21:70")),
+        ("HP device (PC)", ("00:1d:60", "00:23:7d", "00:26:2d")),
+        ("Lenovo device (PC)", ("00:09:6b", "00:0a:e4", "00:13:02")),
+        ("ASUS device (PC)", ("00:17:31", "00:1a:92", "00:21:91")),
+    )
+    for oui in ouis
+}
+
+# Device identities are stable, so repeat polls of the same (hostname, mac) are memoized
+@functools.lru_cache(maxsize=4096)
 def _infer_device_type(hostname: str | None, mac: str | None) -> str:
     hn = (hostname or "").lower()
     mac = (mac or "").lower()
 
-    # Hostname heuristics (expanded)
-    if any(k in hn for k in ["iphone", "ios"]): return "phone (iPhone/iOS)"
-    if any(k in hn for k in ["ipad"]): return "tablet (iPad/iOS)"
-    if any(k in hn for k in ["android", "pixel", "galaxy", "oneplus", "samsung"]): return "phone (Android)"
-    if any(k in hn for k in ["macbook", "imac", "mac-mini", "macpro", "macos"]): return "laptop/desktop (Mac)"
-    if any(k in hn for k in ["intel", "nuc"]): return "desktop (Intel)"
-    if any(k in hn for k in ["windows", "win", "dell", "hp", "lenovo", "thinkpad", "xps", "surface", "msi", "acer", "asus"]): return "laptop/desktop (Windows/PC)"
-    if any(k in hn for k in ["laptop", "notebook"]): return "laptop (generic)"
-    if any(k in hn for k in ["desktop", "pc"]): return "desktop (generic)"
-    if any(k in hn for k in ["roku", "apple-tv", "firetv", "chromecast", "tv"]): return "streaming/TV"
-    if any(k in hn for k in ["ps5", "ps4", "xbox", "switch"]): return "game console"
-
-    # OUI (MAC prefix) heuristics (expanded)
+    for pattern, label in _HOSTNAME_PATTERNS:
+        if pattern.search(hn):
+            return label
+
     oui = mac[:8] if len(mac) >= 8 else ""
-    apple_ouis = {"88:e9:fe", "d8:30:62", "8c:85:90", "f0:18:98", "a4:5e:60", "b8:8d:12", "ac:bc:32"}
-    samsung_ouis = {"1c:5a:6b", "14:32:d1", "30:07:4d", "f4:09:d8", "00:16:6c"}
-    google_ouis = {"3c:5a:b4", "f4:f5:d8", "a4:77:33", "e4:f0:42"}
-    intel_ouis = {"00:1b:21", "00:13:e8", "00:03:47", "00:15:17"}
-    dell_ouis = {"00:14:22", "00:1a:a0", "00:21:70"}
-    hp_ouis = {"00:1d:60", "00:23:7d", "00:26:2d"}
-    lenovo_ouis = {"00:09:6b", "00:0a:e4", "00:13:02"}
-    asus_ouis = {"00:17:31", "00:1a:92", "00:21:91"}
-    if oui in apple_ouis: return "Apple device (Mac/iOS)"
-    if oui in samsung_ouis: return "Samsung device (Android)"
-    if oui in google_ouis: return "Google device (Android/IoT)"
-    if oui in intel_ouis: return "Intel device (PC/NIC)"
-    if oui in dell_ouis: return "Dell device (PC)"
-    if oui in hp_ouis: return "HP device (PC)"
-    if oui in lenovo_ouis: return "Lenovo device (PC)"
-    if oui in asus_ouis: return "ASUS device (PC)"
-
-    # Fallback
-    return "unknown"
+    return _OUI_MAP.get(oui, "unknown")
+
+# Built once; browsers may cache it for a year and revalidate with the ETag
+_FAVICON = (
+    "<svg xmlns='http://www.w3.org/2000/svg' width='64' height='64' viewBox='0 0 64 64'>"
+    "<defs><linearGradient id='g' x1='0' x2='1' y1='0' y2='1'><stop offset='0%' stop-color='#667eea'/><stop offset='100%' stop-color='#764ba2'/></linearGradient></defs>"
+    "<rect width='64' height='64' rx='12' fill='url(#g)'/>"
+    "<circle cx='32' cy='32' r='18' fill='none' stroke='white' stroke-width='3'/>"
+    "<path d='M14 32 H50' stroke='white' stroke-width='3' stroke-linecap='round'/>"
+    "<path d='M32 14 V50' stroke='white' stroke-width='3' stroke-linecap='round'/>"
+    "</svg>"
+).encode("utf-8")
+_FAVICON_ETAG = hashlib.sha1(_FAVICON).hexdigest()[:16]
 
 @app.route('/favicon.ico')
 def favicon():
     """Serve a tiny inline SVG favicon to avoid 404s."""
-    svg = (
-        "<svg xmlns='http://www.w3.org/2000/svg' width='64' height='64' viewBox='0 0 64 64'>"
-        "<defs><linearGradient id='g' x1='0' x2='1' y1='0' y2='1'><stop offset='0%' stop-color='#667eea'/><stop offset='100%' stop-color='#764ba2'/></linearGradient></defs>"
-        "<rect width='64' height='64' rx='12' fill='url(#g)'/>"
-        "<circle cx='32' cy='32' r='18' fill='none' stroke='white' stroke-width='3'/>"
-        "<path d='M14 32 H50' stroke='white' stroke-width='3' stroke-linecap='round'/>"
-        "<path d='M32 14 V50' stroke='white' stroke-width='3' stroke-linecap='round'/>"
-        "</svg>"
-    )
-    return Response(svg, mimetype='image/svg+xml')
+    resp = Response(_FAVICON, mimetype='image/svg+xml')
+    resp.set_etag(_FAVICON_ETAG)
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp.make_conditional(request)
 
 @app.route('/')
 def index():
@@ -92,7 +136,7 @@ def get_metrics():
     analysis = analyze_network()
 
     if not analysis:
-        return jsonify({
+        return _json_response({
             "status": "waiting",
             "message": "Collecting metrics... Please wait."
         })
@@ -123,82 +167,128 @@ def get_metrics():
             "max": round(baseline + 10.0, 1)
         }
     }
-    return jsonify(payload)
+    return _json_response(payload)
 
 @app.route('/api/diagnosis')
 def get_diagnosis():
     """Get LLM-powered network diagnosis (with fallback)."""
     diagnosis = get_llm_diagnosis()
-    return jsonify({ "diagnosis": diagnosis })
+    return _json_response({ "diagnosis": diagnosis })
+
+@app.route('/api/diagnosis/stream')
+def stream_diagnosis():
+    """Stream the diagnosis as server-sent events while Gemini generates it."""
+    def events():
+        for text in stream_llm_diagnosis():
+            yield f"data: {json.dumps(text)}\n\n"
+        yield "event: done\ndata: {}\n\n"
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 @app.route('/api/summary')
 def api_summary():
     """Summarize last 5 minutes of samples for quick trend view."""
     try:
-        rows = get_recent_metrics(seconds=300)  # (latency, packet_loss, rx_bytes, tx_bytes, timestamp)
-        if not rows:
-            return jsonify({
+        stats = get_summary_stats(seconds=300)
+        if not stats or not stats["samples"]:
+            return _json_response({
                 "status": "waiting",
                 "message": "No recent samples to summarize"
             })
 
-        latencies = [r[0] for r in rows if r[0] is not None]
-        losses = [r[1] for r in rows if r[1] is not None]
-
-        def _percentile(arr, p):
-            if not arr:
-                return None
-            arr = sorted(arr)
-            k = (len(arr) - 1) * (p / 100.0)
-            f = int(k)
-            c = min(f + 1, len(arr) - 1)
-            if f == c:
-                return arr[int(k)]
-            return arr[f] + (arr[c] - arr[f]) * (k - f)
-
-        avg_latency = sum(latencies)/len(latencies) if latencies else None
-        max_latency = max(latencies) if latencies else None
-        p95_latency = _percentile(latencies, 95) if latencies else None
-        avg_loss = sum(losses)/len(losses) if losses else None
-
-        return jsonify({
+        avg_latency = stats["avg_latency"]
+        p95_latency = get_p95_latency(seconds=300)
+        max_latency = stats["max_latency"]
+        avg_loss = stats["avg_packet_loss"]
+
+        return _json_response({
             "status": "ok",
             "window_seconds": 300,
-            "samples": len(rows),
+            "samples": stats["samples"],
             "avg_latency": round(avg_latency, 1) if avg_latency is not None else None,
             "p95_latency": round(p95_latency, 1) if p95_latency is not None else None,
             "max_latency": round(max_latency, 1) if max_latency is not None else None,
             "avg_packet_loss": round(avg_loss, 2) if avg_loss is not None else None
         })
     except Exception as e:
-        return jsonify({"status":"error", "error": str(e)}), 500
+        return _json_response({"status":"error", "error": str(e)}, 500)
+
+# Gemini calls for /api/devices run on a small pool so the route never waits on
+# the LLM; it serves the last diagnosis per device (ip -> (text, expiry)).
+DEVICE_DIAGNOSIS_TTL = 60  # seconds
+_llm_executor = ThreadPoolExecutor(max_workers=2)
+_diagnosis_cache = {}
+_diagnosis_pending = set()
+_diagnosis_lock = threading.Lock()
+
+def _refresh_diagnosis(ip):
+    try:
+        text = get_llm_diagnosis()
+    except Exception as e:
+        print(f"[devices] diagnosis for {ip} failed: {e}")
+        text = None
+    with _diagnosis_lock:
+        if text:
+            _diagnosis_cache[ip] = (text, time.monotonic() + DEVICE_DIAGNOSIS_TTL)
+        _diagnosis_pending.discard(ip)
+
+def _device_diagnosis(ip):
+    """Return the cached diagnosis for a device (None if there is none yet) and
+    schedule a background refresh once it has expired."""
+    with _diagnosis_lock:
+        text, expiry = _diagnosis_cache.get(ip, (None, 0.0))
+        if expiry <= time.monotonic() and ip not in _diagnosis_pending:
+            _diagnosis_pending.add(ip)
+            _llm_executor.submit(_refresh_diagnosis, ip)
+    return text
+
+@ttl_cache(30)
+def _cached_discover():
+    """Device discovery is slow (neighbour table + reverse DNS); reuse it between polls."""
+    return discover_devices()
 
 @app.route('/api/devices')
 def api_devices():
     """Return discovered devices, with type, threshold status, alert, and sustained issue report."""
-    import datetime
     try:
-        devs = discover_devices()  # expected dicts with keys: ip, mac, hostname
+        devs = _cached_discover()  # expected dicts with keys: ip, mac, hostname
+
+        # One range scan over the last 10 minutes feeds both the latest sample
+        # (rn = 1) and the per-device threshold violation count (per-device
+        # overrides are passed in as JSON and fall back to the global thresholds)
+        ten_min_ago = int(time.time()) - 600
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute('''
+                WITH thr AS (
+                    SELECT key AS device_ip,
+                           json_extract(value, '$.latency') AS latency,
+                           json_extract(value, '$.loss') AS loss
+                    FROM json_each(?)
+                ),
+                recent AS (
+                    SELECT m.device_ip, m.latency, m.packet_loss,
+                           ROW_NUMBER() OVER (PARTITION BY m.device_ip ORDER BY m.timestamp DESC) AS rn,
+                           SUM(CASE WHEN m.latency > COALESCE(t.latency, ?)
+                                      OR m.packet_loss > COALESCE(t.loss, ?)
+                                    THEN 1 ELSE 0 END) OVER (PARTITION BY m.device_ip) AS viol
+                    FROM device_metrics m
+                    LEFT JOIN thr t ON t.device_ip = m.device_ip
+                    WHERE m.timestamp > ?
+                )
+                SELECT device_ip, latency, packet_loss, viol
+                FROM recent
+                WHERE rn = 1
+            ''', (json.dumps(PER_DEVICE_THRESHOLDS), GLOBAL_THRESHOLDS['latency'],
+                  GLOBAL_THRESHOLDS['loss'], ten_min_ago))
+            stats = {r[0]: r[1:] for r in c.fetchall()}
+
         enriched = []
         for d in devs:
             ip = d.get("ip")
             mac = d.get("mac")
             hostname = d.get("hostname")
             dtype = _infer_device_type(hostname, mac)
-
-            # Get most recent metrics for this device
-            conn = sqlite3.connect('data.db')
-            c = conn.cursor()
-            c.execute('''
-                SELECT latency, packet_loss, timestamp
-                FROM device_metrics
-                WHERE device_ip = ?
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''', (ip,))
-            row = c.fetchone()
-            latency = row[0] if row else None
-            loss = row[1] if row else None
+            latency, loss, count = stats.get(ip, (None, None, 0))
 
             # Determine thresholds
             thresholds = PER_DEVICE_THRESHOLDS.get(ip, GLOBAL_THRESHOLDS)
@@ -211,42 +301,18 @@ def api_devices():
                 exceeded = True
                 reasons.append(f"loss {loss:.1f}% > {thresholds['loss']}%")
 
-            # Alert message (can call Gemini here if exceeded)
+            # Alert message (last Gemini diagnosis if one is cached, refreshed in the background)
             alert_message = None
             if exceeded:
-                try:
-                    from llm_wrapper import get_llm_diagnosis
-                    alert_message = get_llm_diagnosis()
-                except Exception:
-                    alert_message = "Threshold exceeded: " + ", ".join(reasons)
+                alert_message = _device_diagnosis(ip) or "Threshold exceeded: " + ", ".join(reasons)
 
-            # Check for sustained issues in last 10 minutes (>=3 threshold violations)
+            # Sustained issue: >=3 threshold violations in the last 10 minutes
             sustained_issue = False
             sustained_report = None
-            try:
-                ten_min_ago = (datetime.datetime.now() - datetime.timedelta(minutes=10)).isoformat()
-                c.execute('''
-                    SELECT latency, packet_loss, timestamp
-                    FROM device_metrics
-                    WHERE device_ip = ? AND timestamp > ?
-                ''', (ip, ten_min_ago))
-                rows = c.fetchall()
-                count = 0
-                for r in rows:
-                    l, pl, _ = r
-                    if (l is not None and l > thresholds['latency']) or (pl is not None and pl > thresholds['loss']):
-                        count += 1
-                if count >= 3:
-                    sustained_issue = True
-                    # Call Gemini for a custom report
-                    try:
-                        from llm_wrapper import get_llm_diagnosis
-                        sustained_report = get_llm_diagnosis()
-                    except Exception:
-                        sustained_report = f"Device exceeded thresholds {count} times in last 10 minutes."
-            except Exception:
-                pass
-            conn.close()
+            if count >= 3:
+                sustained_issue = True
+                sustained_report = (_device_diagnosis(ip)
+                                    or f"Device exceeded thresholds {count} times in last 10 minutes.")
 
             enriched.append({
                 **d,
@@ -256,41 +322,47 @@ def api_devices():
                 "sustained_issue": sustained_issue,
                 "sustained_report": sustained_report
             })
-        return jsonify({ 'devices': enriched })
+        return _json_response({ 'devices': enriched })
     except Exception as e:
         # Keep UI responsive even if discovery fails
-        return jsonify({ 'devices': [], 'error': str(e) }), 200
+        return _json_response({ 'devices': [], 'error': str(e) }, 200)
+
+@app.route('/api/devices/refresh', methods=['POST'])
+def api_devices_refresh():
+    """Drop the cached device list so the next /api/devices call rescans."""
+    _cached_discover.cache_clear()
+    return _json_response({ 'status': 'ok' })
 
 @app.route('/api/device/<ip>/metrics')
 def api_device_metrics(ip):
     """Return recent metrics for a device from the DB."""
     try:
-        conn = sqlite3.connect('data.db')
-        c = conn.cursor()
-        c.execute('''
-            SELECT timestamp, latency, packet_loss, up
-            FROM device_metrics
-            WHERE device_ip = ?
-            ORDER BY timestamp DESC
-            LIMIT 100
-        ''', (ip,))
-        rows = c.fetchall()
-        conn.close()
-
-        data = []
-        for r in rows:
-            data.append({
-                'timestamp': r[0],
-                'latency': r[1],
-                'packet_loss': r[2],
-                'up': bool(r[3])
-            })
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT timestamp, latency, packet_loss, up
+                FROM device_metrics
+                WHERE device_ip = ?
+                ORDER BY timestamp DESC
+                LIMIT 100
+            ''', (ip,))
+            c.arraysize = 50
+            # Row factory on this cursor only; the shared connection keeps returning tuples
+            c.row_factory = sqlite3.Row
+
+            data = []
+            while rows := c.fetchmany():
+                data.extend(dict(r, up=bool(r['up'])) for r in rows)
 
-        return jsonify({ 'device': ip, 'metrics': data })
+        return _json_response({ 'device': ip, 'metrics': data })
     except Exception as e:
-        return jsonify({ 'error': str(e) }), 500
+        return _json_response({ 'error': str(e) }, 500)
 
 # Removed ARP scan on import (it can block/fail in some environments)
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Debug mode is opt-in (FLASK_DEBUG=1). The reloader stays off either way:
+    # it re-imports this module in a child process, which would start a second
+    # collector writing to the same database.
+    debug = os.getenv("FLASK_DEBUG", "").lower() in ("1", "true", "yes")
+    app.run(debug=debug, use_reloader=False, host='0.0.0.0', port=5000)
@@ -0,0 +1,56 @@
+import functools
+import threading
+import time
+
+def ttl_cache(ttl, maxsize=None):
+    """Memoize a function's result per argument set for `ttl` seconds.
+
+    The collector only writes every few seconds, so dashboard polls in between
+    can reuse the last result. Call `func.cache_clear()` to drop entries early.
+    `func.cache_get(*args)` returns a live cached value (or None) without calling
+    func, and `func.cache_set(value, *args)` stores one computed elsewhere.
+    With `maxsize`, expired entries are purged once the cache is full and the
+    oldest live ones are evicted if that is not enough.
+    """
+    def decorator(func):
+        entries = {}  # key -> (value, expiry)
+        lock = threading.Lock()
+
+        def store(key, value, now):
+            with lock:
+                if maxsize is not None and len(entries) >= maxsize and key not in entries:
+                    for k in [k for k, (_, expiry) in entries.items() if expiry <= now]:
+                        del entries[k]
+                    while len(entries) >= maxsize:
+                        del entries[next(iter(entries))]
+                entries[key] = (value, now + ttl)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            with lock:
+                hit = entries.get(key)
+                if hit and hit[1] > now:
+                    return hit[0]
+            value = func(*args, **kwargs)
+            store(key, value, now)
+            return value
+
+        def cache_get(*args, **kwargs):
+            with lock:
+                hit = entries.get((args, tuple(sorted(kwargs.items()))))
+            return hit[0] if hit and hit[1] > time.monotonic() else None
+
+        def cache_set(value, *args, **kwargs):
+            store((args, tuple(sorted(kwargs.items()))), value, time.monotonic())
+
+        def cache_clear():
+            with lock:
+                entries.clear()
+
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_get = cache_get
+        wrapper.cache_set = cache_set
+        return wrapper
+    return decorator
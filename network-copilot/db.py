@@ -0,0 +1,46 @@
+import queue
+import sqlite3
+from contextlib import contextmanager
+
+DB_PATH = "data.db"
+
+# Applied once per connection; WAL lets the API read while the collector writes
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
+)
+
+# Idle read connections kept for reuse; a busy pool opens extra ones, which are
+# closed on return instead of growing it
+POOL_SIZE = 4
+_pool = queue.Queue(maxsize=POOL_SIZE)
+
+def connect(**kwargs):
+    """Open a new SQLite connection with the shared pragmas applied."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256, **kwargs)
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+@contextmanager
+def get_conn():
+    """Borrow an autocommit read connection from the shared pool.
+
+    Use as `with get_conn() as conn:`; the connection goes back to the pool
+    on exit, whichever thread borrowed it.
+    """
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = connect(isolation_level=None)
+    try:
+        yield conn
+    finally:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
@@ -1,7 +1,80 @@
 
 import subprocess
 import re
+import shutil
 import socket
+from concurrent.futures import ThreadPoolExecutor
+from cache import ttl_cache
+
+# pyroute2 is optional; without it the neighbour table is read from `ip neigh`
+try:
+    from pyroute2 import IPRoute
+    HAS_PYROUTE2 = True
+except ImportError:
+    HAS_PYROUTE2 = False
+
+_NUD_NOARP = 0x40
+
+# icmplib is optional; it pings from this process over an unprivileged ICMP socket
+# (allowed by net.ipv4.ping_group_range). Without it, or without that permission,
+# the ping/fping binaries are used.
+try:
+    import icmplib
+    HAS_ICMPLIB = True
+except ImportError:
+    HAS_ICMPLIB = False
+_icmp_ok = HAS_ICMPLIB
+
+# `arp -a` line format: hostname (10.0.0.5) at aa:bb:cc:dd:ee:ff ...
+_ARP_RE = re.compile(r"([\w\-]+) \((\d+\.\d+\.\d+\.\d+)\) at ([0-9a-f:]+)")
+
+# `ping` output: first reply time and the summary's loss percentage (the loss
+# pattern is public because metrics_collector parses the same summary line)
+_PING_TIME_RE = re.compile(r"time=([0-9.]+)\s*ms")
+PING_LOSS_RE = re.compile(r"([0-9.]+)% packet loss")
+
+# `fping -q` summary line: 10.0.0.5 : xmt/rcv/%loss = 1/1/0%, min/avg/max = 3.41/3.41/3.41
+_FPING_RE = re.compile(r"^(\S+)\s*: xmt/rcv/%loss = \d+/\d+/(\d+(?:\.\d+)?)%(?:, min/avg/max = [\d.]+/([\d.]+)/)?", re.M)
+
+# Pings and DNS lookups spend their time blocked, so threads overlap them well
+_io_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="discovery")
+
+@ttl_cache(600, maxsize=1024)
+def _reverse_dns(ip):
+    """Hostname for ip, or None. Up to 1024 results (misses included) are kept for 10 minutes."""
+    try:
+        return socket.gethostbyaddr(ip)[0]
+    except Exception:
+        return None
+
+def _neighbours():
+    """Return (ip, mac) pairs from the kernel neighbour table.
+
+    Reads it over netlink with pyroute2 when available; otherwise parses
+    `ip neigh`. Raises if neither works so the caller can try `arp -a`.
+    """
+    if HAS_PYROUTE2:
+        try:
+            with IPRoute() as ipr:
+                # Skip NOARP entries (multicast, 0.0.0.0), which `ip neigh` hides too
+                return [(n.get_attr('NDA_DST'), n.get_attr('NDA_LLADDR'))
+                        for n in ipr.get_neighbours() if not n['state'] & _NUD_NOARP and n.get_attr('NDA_DST')]
+        except Exception:
+            pass
+
+    neighbours = []
+    out = subprocess.check_output(['ip', 'neigh'], text=True)
+    for line in out.splitlines():
+        # format: 10.0.0.5 dev wlan0 lladdr aa:bb:cc:dd:ee:ff REACHABLE
+        parts = line.split()
+        if len(parts) >= 1:
+            mac = None
+            if 'lladdr' in parts:
+                idx = parts.index('lladdr')
+                if idx+1 < len(parts):
+                    mac = parts[idx+1]
+            neighbours.append((parts[0], mac))
+    return neighbours
 
 def discover_devices():
     """Discover devices on the local network using `ip neigh` and `arp -a` as fallback.
@@ -9,29 +82,15 @@ def discover_devices():
     """
     devices = {}
     try:
-        out = subprocess.check_output(['ip', 'neigh'], text=True)
-        for line in out.splitlines():
-            # format: 10.0.0.5 dev wlan0 lladdr aa:bb:cc:dd:ee:ff REACHABLE
-            parts = line.split()
-            if len(parts) >= 1:
-                ip = parts[0]
-                mac = None
-                if 'lladdr' in parts:
-                    idx = parts.index('lladdr')
-                    if idx+1 < len(parts):
-                        mac = parts[idx+1]
-                hostname = None
-                try:
-                    hostname = socket.gethostbyaddr(ip)[0]
-                except Exception:
-                    hostname = None
-
-                devices[ip] = { 'ip': ip, 'mac': mac, 'hostname': hostname }
+        neighbours = _neighbours()
+        hostnames = _io_pool.map(_reverse_dns, [ip for ip, _ in neighbours])
+        for (ip, mac), hostname in zip(neighbours, hostnames):
+            devices[ip] = { 'ip': ip, 'mac': mac, 'hostname': hostname }
     except Exception:
         # fallback to arp -a
         try:
             out = subprocess.check_output(['arp', '-a'], text=True)
-            matches = re.findall(r"([\w\-]+) \((\d+\.\d+\.\d+\.\d+)\) at ([0-9a-f:]+)", out)
+            matches = _ARP_RE.findall(out)
             for m in matches:
                 name, ip, mac = m
                 devices[ip] = { 'ip': ip, 'mac': mac, 'hostname': name }
@@ -40,30 +99,72 @@ def discover_devices():
 
     return list(devices.values())
 
+def _icmp_result(host):
+    return (host.avg_rtt if host.is_alive else None), host.packet_loss * 100.0, host.is_alive
+
+def icmp_ping(ip, count=1, timeout=2):
+    """Ping with icmplib; (avg_latency_ms, packet_loss_pct, up_bool), or None if icmplib can't be used."""
+    global _icmp_ok
+    if not _icmp_ok:
+        return None
+    try:
+        return _icmp_result(icmplib.ping(ip, count=count, timeout=timeout, privileged=False))
+    except icmplib.SocketPermissionError:
+        # ICMP sockets are not allowed for this user; stop trying
+        _icmp_ok = False
+        return None
+    except Exception:
+        return None, 100.0, False
+
 def ping_host(ip, count=1, timeout=2):
     """Ping a host once and return (latency_ms, packet_loss_pct, up_bool)."""
+    result = icmp_ping(ip, count=count, timeout=timeout)
+    if result is not None:
+        return result
     try:
         # Use single ping packet
         result = subprocess.run(['ping', '-c', str(count), '-W', str(timeout), ip], capture_output=True, text=True)
         out = result.stdout
-        latency = None
-        packet_loss = 100.0
-        up = False
-        for line in out.splitlines():
-            if 'packet loss' in line:
-                try:
-                    packet_loss = float(line.split('%')[0].strip().split()[-1])
-                except Exception:
-                    packet_loss = 100.0
-            if 'time=' in line:
-                # example: 64 bytes from 10.0.0.1: icmp_seq=1 ttl=64 time=3.45 ms
-                m = re.search(r'time=([0-9\.]+)\s*ms', line)
-                if m:
-                    try:
-                        latency = float(m.group(1))
-                    except Exception:
-                        latency = None
+        # example: 64 bytes from 10.0.0.1: icmp_seq=1 ttl=64 time=3.45 ms
+        m = _PING_TIME_RE.search(out)
+        latency = float(m.group(1)) if m else None
+        m = PING_LOSS_RE.search(out)
+        packet_loss = float(m.group(1)) if m else 100.0
         up = (packet_loss < 100.0)
         return latency, packet_loss, up
     except Exception:
         return None, None, False
+
+def ping_hosts(ips, timeout=2):
+    """Ping many hosts concurrently; returns {ip: (latency_ms, packet_loss_pct, up_bool)}.
+
+    Uses icmplib's multiping or a single `fping` process when available,
+    otherwise runs ping_host for each address on a thread pool. Either way a
+    tick takes about one timeout instead of one per host.
+    """
+    global _icmp_ok
+    ips = list(ips)
+    if not ips:
+        return {}
+    if _icmp_ok:
+        try:
+            hosts = icmplib.multiping(ips, count=1, timeout=timeout, privileged=False)
+            return {ip: _icmp_result(host) for ip, host in zip(ips, hosts)}
+        except icmplib.SocketPermissionError:
+            _icmp_ok = False
+        except Exception:
+            pass
+    if shutil.which('fping'):
+        try:
+            result = subprocess.run(['fping', '-q', '-c', '1', '-t', str(timeout * 1000), *ips],
+                                    capture_output=True, text=True)
+            # fping writes its per-host summary to stderr
+            results = {}
+            for ip, loss, avg in _FPING_RE.findall(result.stderr):
+                loss = float(loss)
+                results[ip] = (float(avg) if avg else None, loss, loss < 100.0)
+            if results:
+                return {ip: results.get(ip, (None, 100.0, False)) for ip in ips}
+        except Exception:
+            pass
+    return dict(zip(ips, _io_pool.map(lambda ip: ping_host(ip, timeout=timeout), ips)))
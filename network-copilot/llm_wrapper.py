@@ -1,7 +1,13 @@
-import os
+import atexit
 import json
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv, find_dotenv
 from analyzer import analyze_network
+from cache import ttl_cache
 
 # Load .env from the nearest location (workspace root or current folder)
 _dotenv_path = find_dotenv(usecwd=True)
@@ -14,19 +20,108 @@ try:
 except ImportError:
     HAS_GEMINI = False
 
-def _log(msg: str):
-    print(f"[Gemini] {msg}")
+# Log records are queued and written to stdout by a listener thread, so a Gemini
+# call never waits on console I/O. Per-call chatter is DEBUG and only shown when
+# FLASK_DEBUG is on; fallbacks and errors are always logged. Messages take
+# %-style arguments, which are only formatted if the record passes the level.
+_logger = logging.getLogger("gemini")
+_logger.setLevel(logging.DEBUG if os.getenv("FLASK_DEBUG", "").lower() in ("1", "true", "yes") else logging.INFO)
+_logger.propagate = False
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter("[Gemini] %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_logger.addHandler(QueueHandler(_log_queue))
+
+# Configured model, created on first use and reused while the API key is unchanged
+_model = None
+_model_id = None
+_model_key = None
+
+def _get_model(api_key):
+    """Configure the SDK and pick the first available model, once per process."""
+    global _model, _model_id, _model_key
+    if _model is not None and _model_key == api_key:
+        return _model
+
+    genai.configure(api_key=api_key)
+
+    # Prefer widely-available models first, with fallback
+    model_ids = [
+        "gemini-pro",
+        "gemini-1.5-flash",
+        "gemini-1.5-pro"
+    ]
+    last_err = None
+    for mid in model_ids:
+        try:
+            _logger.debug("Attempting model '%s'", mid)
+            model = genai.GenerativeModel(mid)
+            _logger.debug("Using model '%s'", mid)
+            break
+        except Exception as me:
+            last_err = me
+            _logger.info("Model '%s' unavailable: %s", mid, me)
+    else:
+        raise RuntimeError(f"No Gemini model available: {last_err}")
 
+    _model, _model_id, _model_key = model, mid, api_key
+    return model
 
-def get_llm_diagnosis():
-    """Get LLM-powered diagnosis of network issues using Gemini."""
+# Seconds a Gemini answer is reused for an identical (bucketed) prompt
+LLM_CACHE_TTL = 120
+
+def _bucket(value, ndigits):
+    """Value rounded to ndigits decimals, as prompt text ("~24", "~0.2").
+
+    Near-identical readings share a prompt, and so a cached answer; the "~"
+    tells Gemini the figure is approximate.
+    """
+    return f"~{round(value, ndigits) or 0:.{ndigits}f}"
+
+def _response_text(response):
+    """Text of a Gemini response or stream chunk, or None if it carries none."""
+    try:
+        return response.text
+    except (AttributeError, ValueError):
+        # .text raises ValueError when there is no single text part;
+        # some SDK versions only expose the candidates
+        pass
+    try:
+        return response.candidates[0].content.parts[0].text
+    except (AttributeError, IndexError, TypeError):
+        return None
+
+@ttl_cache(LLM_CACHE_TTL, maxsize=256)
+def _generate(model_id, prompt):
+    """Gemini's answer to prompt on the configured model; raises if it returns no text.
+
+    Memoized on (model_id, prompt), so repeated network states skip the API
+    round trip. Failures raise instead of returning and are never cached.
+    """
+    _logger.debug("Calling Gemini generate_content()")
+    text = _response_text(_model.generate_content(prompt))
+    if not text:
+        raise ValueError("Empty response from Gemini")
+    _logger.debug("Received response from Gemini.")
+    return text
+
+
+def _prepare_diagnosis():
+    """Work out what to ask Gemini: returns (network_data, prompt, answer).
+
+    answer is set when no Gemini call should be made (no metrics yet, SDK or
+    key missing, no usable model); otherwise prompt is the text to send.
+    """
 
     # Get current network analysis
     analysis = analyze_network()
 
     if not analysis:
-        _log("No analysis available; returning wait message.")
-        return "No network metrics available yet. Please wait for the metrics collector to gather data."
+        _logger.info("No analysis available; returning wait message.")
+        return None, None, "No network metrics available yet. Please wait for the metrics collector to gather data."
 
     # Prepare data for LLM
     network_data = {
@@ -41,81 +136,99 @@ def get_llm_diagnosis():
     # If no API key or SDK missing, return rule-based response
     api_key = os.getenv("GEMINI_API_KEY")
     if not HAS_GEMINI:
-        _log("google.generativeai not installed; using rule-based response.")
-        return generate_rule_based_response(network_data, network_data["summary"])
+        _logger.info("google.generativeai not installed; using rule-based response.")
+        return network_data, None, generate_rule_based_response(network_data, network_data["summary"])
     if not api_key:
-        _log("GEMINI_API_KEY not set; using rule-based response.")
-        return generate_rule_based_response(network_data, network_data["summary"])
+        _logger.info("GEMINI_API_KEY not set; using rule-based response.")
+        return network_data, None, generate_rule_based_response(network_data, network_data["summary"])
 
     try:
-        genai.configure(api_key=api_key)
-
-        # Prefer widely-available models first, with fallback
-        model_ids = [
-            "gemini-pro",
-            "gemini-1.5-flash",
-            "gemini-1.5-pro"
-        ]
-        model = None
-        last_err = None
-        for mid in model_ids:
-            try:
-                _log(f"Attempting model '{mid}'")
-                model = genai.GenerativeModel(mid)
-                _log(f"Using model '{mid}'")
-                break
-            except Exception as me:
-                last_err = me
-                _log(f"Model '{mid}' unavailable: {me}")
-        if model is None:
-            raise RuntimeError(f"No Gemini model available: {last_err}")
-
-        prompt = (
-            "You are a network diagnostics assistant. Based on the following network metrics, "
-            "provide a brief (2-3 sentence) diagnosis of what's happening with the network.\n\n"
-            f"Network Data:\n- Current Latency: {network_data['current_latency_ms']}ms\n"
-            f"- Baseline Latency: {network_data['baseline_latency_ms']}ms\n"
-            f"- Latency Change: {network_data['latency_increase_percent']}%\n"
-            f"- Packet Loss: {network_data['packet_loss_percent']}%\n\n"
-            "Provide a concise, actionable explanation. If all metrics are normal, say so briefly."
-        )
-
-        _log("Calling Gemini generate_content()")
-        response = model.generate_content(prompt)
-        text = getattr(response, "text", None)
-        if not text:
-            # Some SDK versions return candidates
-            try:
-                text = response.candidates[0].content.parts[0].text
-            except Exception:
-                text = None
-        if text:
-            _log("Received response from Gemini.")
-            return text
-        else:
-            _log("Empty response from Gemini; using rule-based response.")
-            return generate_rule_based_response(network_data, network_data["summary"])
+        _get_model(api_key)
+    except Exception as e:
+        _logger.info("Error calling Gemini API: %s", e)
+        return network_data, None, generate_rule_based_response(network_data, network_data["summary"])
+
+    # Latency/loss are bucketed (1 ms, 1 %, 0.1 %) so small jitter reuses a cached
+    # answer while the figures Gemini quotes stay close to the dashboard's
+    prompt = (
+        "You are a network diagnostics assistant. Based on the following network metrics, "
+        "provide a brief (2-3 sentence) diagnosis of what's happening with the network.\n\n"
+        f"Network Data:\n- Current Latency: {_bucket(network_data['current_latency_ms'], 0)}ms\n"
+        f"- Baseline Latency: {_bucket(network_data['baseline_latency_ms'], 0)}ms\n"
+        f"- Latency Change: {_bucket(network_data['latency_increase_percent'], 0)}%\n"
+        f"- Packet Loss: {_bucket(network_data['packet_loss_percent'], 1)}%\n\n"
+        "Provide a concise, actionable explanation. If all metrics are normal, say so briefly."
+    )
+    return network_data, prompt, None
+
+
+@ttl_cache(30)
+def get_llm_diagnosis():
+    """Get LLM-powered diagnosis of network issues using Gemini."""
+    network_data, prompt, answer = _prepare_diagnosis()
+    if answer is not None:
+        return answer
 
+    try:
+        return _generate(_model_id, prompt)
     except Exception as e:
-        _log(f"Error calling Gemini API: {e}")
+        _logger.info("Error calling Gemini API: %s", e)
         return generate_rule_based_response(network_data, network_data["summary"])
 
+
+def stream_llm_diagnosis():
+    """Yield the diagnosis piece by piece as Gemini generates it.
+
+    Answers already in the _generate cache and fallback answers are yielded
+    whole. A completed stream is stored in that cache, so the next request
+    for the same prompt (streamed or not) skips Gemini. If the stream fails
+    before any text arrives, the rule-based response is yielded instead.
+    """
+    network_data, prompt, answer = _prepare_diagnosis()
+    if answer is None:
+        answer = _generate.cache_get(_model_id, prompt)
+    if answer is not None:
+        yield answer
+        return
+
+    parts = []
+    try:
+        _logger.debug("Streaming Gemini generate_content()")
+        for chunk in _model.generate_content(prompt, stream=True):
+            text = _response_text(chunk)
+            if text:
+                parts.append(text)
+                yield text
+    except Exception as e:
+        _logger.info("Error streaming from Gemini API: %s", e)
+    else:
+        if parts:
+            _generate.cache_set("".join(parts), _model_id, prompt)
+    if not parts:
+        yield generate_rule_based_response(network_data, network_data["summary"])
+
+# Rule-based diagnoses, checked in order: (spike_above_pct, loss_above_pct, template).
+# The first row whose spike or loss threshold is exceeded wins; otherwise _HEALTHY.
+_RULES = (
+    (50, 5, "⚠️ Network degraded significantly. Latency spiked {spike:.0f}% to {latency:.1f}ms (baseline: {baseline:.1f}ms), packet loss at {loss:.1f}%. Try pausing bandwidth-heavy tasks."),
+    (30, 2, "⚠️ Network showing congestion signs. Latency up {spike:.0f}% ({latency:.1f}ms), packet loss {loss:.1f}%. Monitor the situation."),
+    (0, 0, "✓ Network mostly healthy with minor fluctuations. Latency {latency:.1f}ms (baseline: {baseline:.1f}ms), packet loss {loss:.1f}%."),
+)
+_HEALTHY = "✓ Network health is excellent. Latency stable at {latency:.1f}ms, no packet loss detected."
+
 def generate_rule_based_response(network_data, summary):
     """Generate rule-based response when LLM is not available."""
     
-    latency = network_data["current_latency_ms"]
-    baseline = network_data["baseline_latency_ms"]
     spike = network_data["latency_increase_percent"]
     loss = network_data["packet_loss_percent"]
-    
-    if spike > 50 or loss > 5:
-        return f"⚠️ Network degraded significantly. Latency spiked {spike:.0f}% to {latency:.1f}ms (baseline: {baseline:.1f}ms), packet loss at {loss:.1f}%. Try pausing bandwidth-heavy tasks."
-    elif spike > 30 or loss > 2:
-        return f"⚠️ Network showing congestion signs. Latency up {spike:.0f}% ({latency:.1f}ms), packet loss {loss:.1f}%. Monitor the situation."
-    elif spike > 0 or loss > 0:
-        return f"✓ Network mostly healthy with minor fluctuations. Latency {latency:.1f}ms (baseline: {baseline:.1f}ms), packet loss {loss:.1f}%."
-    else:
-        return f"✓ Network health is excellent. Latency stable at {latency:.1f}ms, no packet loss detected."
+
+    template = next((t for spike_above, loss_above, t in _RULES if spike > spike_above or loss > loss_above), _HEALTHY)
+    return template.format(
+        latency=network_data["current_latency_ms"],
+        baseline=network_data["baseline_latency_ms"],
+        spike=spike,
+        loss=loss,
+    )
 
 if __name__ == "__main__":
     diagnosis = get_llm_diagnosis()
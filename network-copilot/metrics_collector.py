@@ -1,26 +1,65 @@
 
-import sqlite3
+import atexit
 import subprocess
 import time
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os
-from device_discovery import discover_devices, ping_host
+import re
+from db import connect
+from device_discovery import PING_LOSS_RE, discover_devices, icmp_ping, ping_hosts
 
-DB_PATH = "data.db"
+# Seconds between planner statistics refreshes (ANALYZE) in the collector
+STATS_REFRESH_INTERVAL = 3600
 
-# Single writer lock to avoid concurrent writes from threads
-_db_lock = threading.Lock()
+# `ping` summary line, e.g. "rtt min/avg/max/mdev = 10.1/15.5/20.3/4.2 ms"
+# (macOS prints min/avg/max/stddev, BusyBox just min/avg/max); packet loss
+# uses the same pattern as device_discovery
+_PING_AVG_RE = re.compile(r"min/avg/max(?:/\w+)? = [\d.]+/([\d.]+)/")
+
+# Rows are buffered and written in one transaction every FLUSH_BATCH_SIZE ticks
+# or FLUSH_INTERVAL seconds, whichever comes first. The default of one tick keeps
+# the dashboard live; raise it (FLUSH_BATCH_SIZE in .env, read by start_collection)
+# to trade freshness for fewer commits. Pending rows are flushed at exit.
+FLUSH_BATCH_SIZE = 1
+FLUSH_INTERVAL = 30
+
+_metrics_buf = deque()  # (timestamp, latency, packet_loss, rx_bytes, tx_bytes)
+_device_buf = deque()   # (device_ip, timestamp, latency, packet_loss, up)
+_pending_ticks = 0
+_last_flush = time.monotonic()
+
+# Long-lived write connection (WAL, busy_timeout via db.connect), opened on first write.
+# The collector thread writes through it, and so does the exit-time flush while that
+# daemon thread may still be running; _writer_lock serializes the two (draining the
+# buffers included). Contention with other processes is left to SQLite's busy_timeout.
+_writer = None
+_writer_lock = threading.Lock()
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        _writer = connect()
+    return _writer
+
+# Runs the upstream ping next to the device sweep in store_metrics
+_ping_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="collector-ping")
+
+# Guards against a second collector thread if start_collection runs twice
+_start_lock = threading.Lock()
+_collector_started = False
 
 def init_db():
     """Initialize SQLite database."""
-    # Use WAL mode and a longer timeout to reduce 'database is locked' errors
-    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    # db.connect() applies WAL, busy_timeout and the other shared pragmas
+    conn = connect()
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS metrics (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            timestamp INTEGER DEFAULT (CAST(strftime('%s','now') AS INTEGER)),
             latency REAL,
             packet_loss REAL,
             rx_bytes INTEGER,
@@ -40,21 +79,53 @@ def init_db():
         CREATE TABLE IF NOT EXISTS device_metrics (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             device_ip TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            timestamp INTEGER DEFAULT (CAST(strftime('%s','now') AS INTEGER)),
             latency REAL,
             packet_loss REAL,
             up INTEGER,
+            rx_bytes INTEGER,
+            tx_bytes INTEGER,
             FOREIGN KEY(device_ip) REFERENCES devices(ip)
         )
     ''')
-    conn.commit()
-    # enable WAL
-    c.execute("PRAGMA journal_mode=WAL;")
+    # Per-device byte counters are read by build_security_snapshot; extend older
+    # databases in place. They stay NULL until the collector has a per-device
+    # counter source.
+    columns = {row[1] for row in c.execute('PRAGMA table_info(device_metrics)')}
+    for col in ('rx_bytes', 'tx_bytes'):
+        if col not in columns:
+            c.execute(f'ALTER TABLE device_metrics ADD COLUMN {col} INTEGER')
+    # Older databases stored DATETIME text (UTC); convert those rows to epoch seconds
+    for table in ('metrics', 'device_metrics'):
+        c.execute(f"UPDATE {table} SET timestamp = CAST(strftime('%s', timestamp) AS INTEGER) WHERE typeof(timestamp) = 'text'")
+    # Every reader filters on timestamp (and device_ip) and orders by newest first
+    c.execute('CREATE INDEX IF NOT EXISTS idx_metrics_ts ON metrics(timestamp)')
+    # The device_metrics index also carries every column the readers select, so
+    # per-device history and the all-device window scans never touch the table
+    c.execute('DROP INDEX IF EXISTS idx_devmetrics_ip_ts')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_devmetrics_ip_ts_cover ON device_metrics(device_ip, timestamp DESC, latency, packet_loss, up, rx_bytes, tx_bytes)')
     conn.commit()
     conn.close()
+    refresh_db_stats()
+
+def refresh_db_stats():
+    """Refresh the query planner's statistics so it keeps choosing the indexes."""
+    try:
+        with _writer_lock:
+            conn = _get_writer()
+            # Sample at most ~400 rows per index so this stays cheap on large databases
+            conn.execute("PRAGMA analysis_limit=400")
+            conn.execute("ANALYZE")
+            conn.execute("PRAGMA optimize")
+            conn.commit()
+    except Exception as e:
+        print(f"Error refreshing DB statistics: {e}")
 
 def get_ping_metrics():
     """Get latency and packet loss from ping."""
+    result = icmp_ping("8.8.8.8", count=4)
+    if result is not None:
+        return result[0], result[1]
     try:
         # Ping 8.8.8.8 (Google DNS) 4 times
         result = subprocess.run(
@@ -66,24 +137,11 @@ def get_ping_metrics():
         
         output = result.stdout
         
-        # Parse latency (avg from the summary line)
-        latency = None
-        packet_loss = 0.0
-        
-        for line in output.split('\n'):
-            if 'min/avg/max' in line or 'min/avg/max/mdev' in line:
-                # Example: min/avg/max/stddev = 10.1/15.5/20.3/4.2 ms
-                parts = line.split('=')[1].strip().split('/')
-                try:
-                    latency = float(parts[1])  # avg
-                except Exception:
-                    latency = None
-            if '%' in line and 'packet' in line.lower():
-                # Example: 0% packet loss
-                try:
-                    packet_loss = float(line.split('%')[0].split()[-1])
-                except Exception:
-                    packet_loss = 0.0
+        # Parse latency (avg from the summary line) and loss, one scan each
+        m = _PING_AVG_RE.search(output)
+        latency = float(m.group(1)) if m else None
+        m = PING_LOSS_RE.search(output)
+        packet_loss = float(m.group(1)) if m else 0.0
         
         return latency, packet_loss
     except Exception as e:
@@ -93,23 +151,25 @@ def get_ping_metrics():
 def get_throughput_metrics():
     """Get RX/TX bytes from /proc/net/dev."""
     try:
-        with open('/proc/net/dev', 'r') as f:
-            lines = f.readlines()
+        with open('/proc/net/dev', 'rb') as f:
+            data = f.read()
         
         # Sum up all non-loopback interfaces
         rx_total = 0
         tx_total = 0
         
-        for line in lines[2:]:  # Skip header
-            if 'lo' in line:  # Skip loopback
+        for line in data.splitlines()[2:]:  # Skip header
+            # Format: "  iface: rx_bytes rx_packets rx_errs ... tx_bytes tx_packets ..."
+            # (the counter can run into the colon, so split on it rather than whitespace)
+            name, _, counters = line.partition(b':')
+            if name.strip() == b'lo':  # Skip loopback only, not every name containing "lo"
                 continue
             
-            # Format: "  iface: rx_bytes rx_packets rx_errs ... tx_bytes tx_packets ..."
-            parts = line.split()
-            if len(parts) >= 10:
+            parts = counters.split()
+            if len(parts) >= 9:
                 try:
-                    rx_total += int(parts[1])
-                    tx_total += int(parts[9])
+                    rx_total += int(parts[0])
+                    tx_total += int(parts[8])
                 except ValueError:
                     pass
         
@@ -118,65 +178,98 @@ def get_throughput_metrics():
         print(f"Error getting throughput metrics: {e}")
         return 0, 0
 
-def store_device_metric(device_ip, latency, packet_loss, up):
-    """Store a single device metric row."""
-    try:
-        with _db_lock:
-            conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
-            c = conn.cursor()
-            c.execute('INSERT OR IGNORE INTO devices (ip, last_seen) VALUES (?, CURRENT_TIMESTAMP)', (device_ip,))
-            c.execute('UPDATE devices SET last_seen=CURRENT_TIMESTAMP WHERE ip=?', (device_ip,))
-            c.execute('''
-                INSERT INTO device_metrics (device_ip, latency, packet_loss, up)
-                VALUES (?, ?, ?, ?)
-            ''', (device_ip, latency, packet_loss, int(bool(up))))
-            conn.commit()
-            conn.close()
-    except Exception as e:
-        print(f"Error storing device metric for {device_ip}: {e}")
+def _flush(force=False):
+    """Write buffered rows once FLUSH_BATCH_SIZE ticks or FLUSH_INTERVAL seconds pile up.
 
-def store_metrics():
-    """Store metrics to database."""
-    latency, packet_loss = get_ping_metrics()
-    rx_bytes, tx_bytes = get_throughput_metrics()
-    
-    if latency is not None:
+    Everything pending goes through executemany in one transaction, so a
+    flush costs one commit (and one WAL sync) however many rows it carries.
+    force writes whatever is pending regardless of the thresholds.
+    """
+    global _pending_ticks, _last_flush
+    with _writer_lock:
+        if not (_metrics_buf or _device_buf):
+            return
+        if not force and _pending_ticks < FLUSH_BATCH_SIZE and time.monotonic() - _last_flush < FLUSH_INTERVAL:
+            return
+        metrics_rows = [_metrics_buf.popleft() for _ in range(len(_metrics_buf))]
+        device_rows = [_device_buf.popleft() for _ in range(len(_device_buf))]
         try:
-            with _db_lock:
-                conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+            with _get_writer() as conn:
                 c = conn.cursor()
-                c.execute('''
-                    INSERT INTO metrics (latency, packet_loss, rx_bytes, tx_bytes)
-                    VALUES (?, ?, ?, ?)
-                ''', (latency, packet_loss, rx_bytes, tx_bytes))
-                conn.commit()
-                conn.close()
-            
-            print(f"[{datetime.now()}] Latency: {latency:.1f}ms, Loss: {packet_loss:.1f}%, RX: {rx_bytes}, TX: {tx_bytes}")
+                c.executemany('''
+                    INSERT INTO metrics (timestamp, latency, packet_loss, rx_bytes, tx_bytes)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', metrics_rows)
+                ips = [(ip,) for ip in {row[0] for row in device_rows}]
+                # One upsert per device instead of INSERT OR IGNORE followed by UPDATE
+                c.executemany('''
+                    INSERT INTO devices (ip, last_seen) VALUES (?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(ip) DO UPDATE SET last_seen = excluded.last_seen
+                ''', ips)
+                c.executemany('''
+                    INSERT INTO device_metrics (device_ip, timestamp, latency, packet_loss, up)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', device_rows)
         except Exception as e:
             print(f"Error writing metrics to DB: {e}")
+        _pending_ticks = 0
+        _last_flush = time.monotonic()
+
+def store_device_metrics(samples):
+    """Buffer one tick of device samples [(ip, latency, packet_loss, up), ...]."""
+    ts = int(time.time())
+    _device_buf.extend((ip, ts, latency, loss, int(bool(up))) for ip, latency, loss, up in samples)
+
+def store_metrics():
+    """Collect one tick of metrics and flush the buffer when it is due."""
+    global _pending_ticks
+    # The 8.8.8.8 ping takes a few seconds; let it run while the LAN is probed
+    ping_future = _ping_executor.submit(get_ping_metrics)
 
-    # Discover devices and ping each (lightweight)
+    # Discover devices and ping each (lightweight); rows are buffered with the tick below
     try:
-        devices = discover_devices()
-        for d in devices:
-            ip = d.get('ip')
-            if not ip:
-                continue
-            # ping once with short timeout
-            latency_d, loss_d, up = ping_host(ip)
-            store_device_metric(ip, latency_d, loss_d, up)
+        ips = [d['ip'] for d in discover_devices() if d.get('ip')]
+        # ping once with short timeout, all hosts at the same time
+        results = ping_hosts(ips)
+        store_device_metrics([(ip, *results[ip]) for ip in ips])
     except Exception as e:
         print(f"Error collecting device metrics: {e}")
 
+    latency, packet_loss = ping_future.result()
+    rx_bytes, tx_bytes = get_throughput_metrics()
+    
+    if latency is not None:
+        _metrics_buf.append((int(time.time()), latency, packet_loss, rx_bytes, tx_bytes))
+        
+        print(f"[{datetime.now()}] Latency: {latency:.1f}ms, Loss: {packet_loss:.1f}%, RX: {rx_bytes}, TX: {tx_bytes}")
+
+    _pending_ticks += 1
+    _flush()
+
 def start_collection(interval=5):
-    """Start background metrics collection."""
+    """Start background metrics collection (at most one collector per process)."""
+    global _collector_started, FLUSH_BATCH_SIZE
+    with _start_lock:
+        if _collector_started:
+            print("Metrics collection already running")
+            return
+        _collector_started = True
+
+    # Read here rather than at import, so a .env loaded by then is honoured
+    FLUSH_BATCH_SIZE = int(os.getenv("FLUSH_BATCH_SIZE", FLUSH_BATCH_SIZE))
     init_db()
+    # Don't lose up to FLUSH_BATCH_SIZE ticks of buffered rows on shutdown
+    atexit.register(_flush, force=True)
     
     def collector():
+        last_stats = time.monotonic()
         while True:
             try:
                 store_metrics()
+                # Rows keep accumulating; re-ANALYZE hourly
+                if time.monotonic() - last_stats >= STATS_REFRESH_INTERVAL:
+                    refresh_db_stats()
+                    last_stats = time.monotonic()
                 time.sleep(interval)
             except Exception as e:
                 print(f"Error in collector: {e}")
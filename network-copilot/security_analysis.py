@@ -1,8 +1,8 @@
 import os
-import sqlite3
 import datetime
 from typing import Dict, Any, List
 
+from db import get_conn
 from device_discovery import discover_devices
 
 # Conservative global thresholds (keep in sync with app defaults, but duplicated to avoid import cycles)
@@ -22,16 +22,55 @@ def _mask_mac(mac: str | None) -> str | None:
     return mac[:8] + 'xx:xx:xx'
 
 
-def _percentile(arr: List[float], p: float) -> float | None:
-    if not arr:
-        return None
-    arr = sorted(arr)
-    k = (len(arr) - 1) * (p / 100.0)
-    f = int(k)
-    c = min(f + 1, len(arr) - 1)
-    if f == c:
-        return arr[int(k)]
-    return arr[f] + (arr[c] - arr[f]) * (k - f)
+# One row per device for the window: aggregates, plus the newest and oldest
+# sample's counters for the average bandwidth
+_Q_DEVICE_STATS = '''
+    WITH w AS (
+        SELECT device_ip, timestamp, latency, packet_loss, rx_bytes, tx_bytes,
+               ROW_NUMBER() OVER (PARTITION BY device_ip ORDER BY timestamp DESC) AS newest,
+               ROW_NUMBER() OVER (PARTITION BY device_ip ORDER BY timestamp) AS oldest
+        FROM device_metrics
+        WHERE timestamp > ?
+    )
+    SELECT device_ip,
+           COUNT(*),
+           MAX(timestamp),
+           AVG(latency),
+           MAX(latency),
+           AVG(packet_loss),
+           SUM(CASE WHEN latency > ? OR packet_loss > ? THEN 1 ELSE 0 END),
+           MAX(CASE WHEN newest = 1 THEN rx_bytes END),
+           MAX(CASE WHEN newest = 1 THEN tx_bytes END),
+           MIN(timestamp),
+           MAX(CASE WHEN oldest = 1 THEN rx_bytes END),
+           MAX(CASE WHEN oldest = 1 THEN tx_bytes END)
+    FROM w
+    GROUP BY device_ip
+'''
+# The two latencies around each device's p95 rank (linear interpolation)
+_Q_DEVICE_P95 = '''
+    SELECT device_ip, latency, k
+    FROM (
+        SELECT device_ip, latency,
+               ROW_NUMBER() OVER (PARTITION BY device_ip ORDER BY latency) - 1 AS rnk,
+               (COUNT(*) OVER (PARTITION BY device_ip) - 1) * 0.95 AS k
+        FROM device_metrics
+        WHERE timestamp > ? AND latency IS NOT NULL
+    )
+    WHERE rnk BETWEEN CAST(k AS INTEGER) AND CAST(k AS INTEGER) + 1
+    ORDER BY device_ip, rnk
+'''
+
+
+def _device_p95(c, cutoff: int) -> Dict[str, float]:
+    """p95 latency per device over the window, computed from two ranks in SQLite."""
+    p95: Dict[str, float] = {}
+    ranks: Dict[str, List[float]] = {}
+    for ip, latency, k in c.execute(_Q_DEVICE_P95, (cutoff,)):
+        ranks.setdefault(ip, []).append(latency)
+        vals = ranks[ip]
+        p95[ip] = vals[0] + ((vals[1] - vals[0]) * (k - int(k)) if len(vals) > 1 else 0.0)
+    return p95
 
 
 def build_security_snapshot(window_seconds: int = 900) -> Dict[str, Any]:
@@ -41,73 +80,53 @@ def build_security_snapshot(window_seconds: int = 900) -> Dict[str, Any]:
         dict with keys: window_seconds, generated_at, devices: [...]
     """
     now = datetime.datetime.now()
-    cutoff = (now - datetime.timedelta(seconds=window_seconds)).isoformat()
+    cutoff = int(now.timestamp()) - window_seconds
 
     devices = discover_devices() or []  # [{ip, mac, hostname}]
 
     snapshot_devices: List[Dict[str, Any]] = []
-    conn = sqlite3.connect('data.db')
-    c = conn.cursor()
+    # Two queries for all devices instead of one query (and a Python pass) per device
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(_Q_DEVICE_STATS, (cutoff, GLOBAL_THRESHOLDS['latency'], GLOBAL_THRESHOLDS['loss']))
+        stats = {row[0]: row[1:] for row in c.fetchall()}
+        p95 = _device_p95(c, cutoff)
 
     for d in devices:
         ip = d.get('ip')
         mac = d.get('mac')
         hostname = d.get('hostname')
 
-        c.execute('''
-            SELECT timestamp, latency, packet_loss, rx_bytes, tx_bytes
-            FROM device_metrics
-            WHERE device_ip = ? AND timestamp > ?
-            ORDER BY timestamp DESC
-        ''', (ip, cutoff))
-        rows = c.fetchall()
-
-        latencies = [r[1] for r in rows if r[1] is not None]
-        losses = [r[2] for r in rows if r[2] is not None]
+        (samples, last_seen, lat_avg, lat_max, loss_avg, violations,
+         rx_new, tx_new, first_seen, rx_old, tx_old) = stats.get(ip, (0, None, None, None, None, 0, None, None, None, None, None))
+        lat_p95 = p95.get(ip)
 
         # Compute avg bandwidth over window using first and last sample
         avg_rx_bps = None
         avg_tx_bps = None
-        if len(rows) >= 2 and rows[0][3] is not None and rows[-1][3] is not None and rows[0][4] is not None and rows[-1][4] is not None:
-            try:
-                t_new = datetime.datetime.fromisoformat(rows[0][0])
-                t_old = datetime.datetime.fromisoformat(rows[-1][0])
-                dt = (t_new - t_old).total_seconds()
-                if dt > 0:
-                    avg_rx_bps = (rows[0][3] - rows[-1][3]) / dt
-                    avg_tx_bps = (rows[0][4] - rows[-1][4]) / dt
-            except Exception:
-                pass
-
-        # Threshold violations count
-        violations = 0
-        for r in rows:
-            l = r[1]
-            pl = r[2]
-            if (l is not None and l > GLOBAL_THRESHOLDS['latency']) or (pl is not None and pl > GLOBAL_THRESHOLDS['loss']):
-                violations += 1
-
-        last_seen = rows[0][0] if rows else None
+        if samples >= 2 and None not in (rx_new, rx_old, tx_new, tx_old):
+            dt = last_seen - first_seen  # epoch seconds
+            if dt > 0:
+                avg_rx_bps = (rx_new - rx_old) / dt
+                avg_tx_bps = (tx_new - tx_old) / dt
 
         device_entry = {
             'ip': ip,
             'masked_mac': _mask_mac(mac),
             'hostname': hostname,
             'last_seen': last_seen,
-            'latency_avg_ms': round(sum(latencies)/len(latencies), 1) if latencies else None,
-            'latency_p95_ms': round(_percentile(latencies, 95), 1) if latencies else None,
-            'latency_max_ms': round(max(latencies), 1) if latencies else None,
-            'loss_avg_pct': round(sum(losses)/len(losses), 2) if losses else None,
+            'latency_avg_ms': round(lat_avg, 1) if lat_avg is not None else None,
+            'latency_p95_ms': round(lat_p95, 1) if lat_p95 is not None else None,
+            'latency_max_ms': round(lat_max, 1) if lat_max is not None else None,
+            'loss_avg_pct': round(loss_avg, 2) if loss_avg is not None else None,
             'sustained_threshold_violations': violations,
             'avg_rx_bps': round(avg_rx_bps, 2) if avg_rx_bps is not None else None,
             'avg_tx_bps': round(avg_tx_bps, 2) if avg_tx_bps is not None else None,
             'threshold_exceeded': violations >= 1,
-            'is_new_device': len(rows) == 0,
+            'is_new_device': samples == 0,
         }
         snapshot_devices.append(device_entry)
 
-    conn.close()
-
     return {
         'window_seconds': window_seconds,
         'generated_at': now.isoformat(),